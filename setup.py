@@ -24,5 +24,8 @@ setup(
     scripts = ['scripts/turkic'],
     package_dir = {"turkic": "turkic"},
     package_data = {"": datafiles},
-    install_requires = ["setuptools", "SQLAlchemy", "wsgilog", "boto3"]
+    python_requires = ">=3.7",
+    # botocore 1.27.84 is the first release whose Config knows tcp_keepalive
+    install_requires = ["setuptools", "SQLAlchemy", "wsgilog",
+                        "boto3>=1.24.84", "botocore>=1.27.84"]
 )
@@ -1,16 +1,70 @@
 from datetime import datetime
+import functools
 import logging
+import re
+import threading
+import time
+import uuid
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger("turkic.api")
 CommunicationError = ClientError
 
+# The default pool of 10 connections throttles bulk publishing and paying, so
+# share one client with a larger pool and let botocore back off on throttling.
+# Calls that spend money pass a UniqueRequestToken so retries are not repeated.
+clientconfig = Config(max_pool_connections=50,
+                      tcp_keepalive=True,
+                      retries={"max_attempts": 10, "mode": "adaptive"})
+
+questiontemplate = ("<ExternalQuestion xmlns=\"http://mechanicalturk"
+                    ".amazonaws.com/AWSMechanicalTurkDataSchemas/"
+                    "2006-07-14/ExternalQuestion.xsd\">"
+                    "<ExternalURL>%s/%s</ExternalURL>"
+                    "<FrameHeight>%s</FrameHeight>"
+                    "</ExternalQuestion>")
+
+
+@functools.lru_cache(maxsize=1024)
+def question(localhost, page, height):
+    """
+    Returns the ExternalQuestion XML for a page, reused across bulk loads.
+    """
+    return questiontemplate % (localhost, page, height)
+
+
+def keepalive(request, **kwargs):
+    """
+    Asks MTurk to hold the connection open so the TLS session is reused.
+    """
+    request.headers["Connection"] = "keep-alive"
+
+
+def duplicaterequest(error):
+    """
+    Tells whether a ClientError is MTurk refusing a retry because it already
+    processed the UniqueRequestToken, i.e. an earlier attempt succeeded.
+    """
+    response = error.response
+    if not response.get("ResponseMetadata", {}).get("RetryAttempts"):
+        # every call sends a fresh token, so only a retry can collide
+        return False
+    turkcode = response.get("TurkErrorCode", "")
+    message = response.get("Error", {}).get("Message", "").lower()
+    return (turkcode.endswith("AlreadyExists") or "Duplicate" in turkcode
+            or "token" in message)
+
 
 class Server(object):
+    # seconds to reuse a fetched account balance before asking MTurk again
+    balancettl = 60
+
     def __init__(self, signature, accesskey, localhost, sandbox=False):
         self.localhost = localhost
+        self.balancecache = None
 
         if sandbox:
             url = "https://mturk-requester-sandbox.us-east-1.amazonaws.com"
@@ -18,7 +72,9 @@ class Server(object):
             url = "https://mturk-requester.us-east-1.amazonaws.com"
 
         self.client = boto3.client('mturk', endpoint_url=url, region_name='us-east-1',
-                                   aws_access_key_id=accesskey, aws_secret_access_key=signature)
+                                   aws_access_key_id=accesskey, aws_secret_access_key=signature,
+                                   config=clientconfig)
+        self.client.meta.events.register('request-created.mturk', keepalive)
 
     def createhit(self, title, description, page, amount, duration,
                   lifetime, keywords="", autoapprove=604800, height=650,
@@ -37,10 +93,11 @@ class Server(object):
         r = {"Title": title,
              "Description": description,
              "Keywords": keywords,
-             "Reward": '%0.2f' % amount,
+             "Reward": format(amount, ".2f"),
              "AssignmentDurationInSeconds": duration,
              "AutoApprovalDelayInSeconds": autoapprove,
-             "LifetimeInSeconds": lifetime}
+             "LifetimeInSeconds": lifetime,
+             "UniqueRequestToken": uuid.uuid4().hex}
 
         qualifications = []
 
@@ -48,33 +105,40 @@ class Server(object):
             qualifications.append({
                 "QualificationTypeId": "000000000000000000L0",
                 "Comparator": "GreaterThanOrEqualTo",
-                "IntegerValue": minapprovedpercent
+                "IntegerValues": [minapprovedpercent]
             })
 
         if minapprovedamount:
             qualifications.append({
                 "QualificationTypeId": "00000000000000000040",
                 "Comparator": "GreaterThanOrEqualTo",
-                "IntegerValue": minapprovedamount
+                "IntegerValues": [minapprovedamount]
             })
 
         if countrycode:
             qualifications.append({
                 "QualificationTypeId": "00000000000000000071",
                 "Comparator": "EqualTo",
-                "IntegerValue": countrycode
+                "LocaleValues": [{"Country": countrycode}]
             })
 
-        r["Question"] = ("<ExternalQuestion xmlns=\"http://mechanicalturk"
-                         ".amazonaws.com/AWSMechanicalTurkDataSchemas/"
-                         "2006-07-14/ExternalQuestion.xsd\">"
-                         "<ExternalURL>{0}/{1}</ExternalURL>"
-                         "<FrameHeight>{2}</FrameHeight>"
-                         "</ExternalQuestion>").format(self.localhost,
-                                                       page, height)
+        if qualifications:
+            r["QualificationRequirements"] = qualifications
 
-        r = self.client.create_hit(**r)
-        return r
+        r["Question"] = question(self.localhost, page, height)
+
+        try:
+            return self.client.create_hit(**r)
+        except ClientError as e:
+            if not duplicaterequest(e):
+                raise
+            # the HIT went live on an attempt that timed out; MTurk names it
+            hitid = re.search(r"\b[A-Z0-9]{30}\b", e.response["Error"]["Message"])
+            if not hitid:
+                raise
+            logger.warning("Recovered HIT {0} from a retried create_hit"
+                           .format(hitid.group(0)))
+            return self.client.get_hit(HITId=hitid.group(0))
 
     def disable(self, hitid):
         """
@@ -111,12 +175,21 @@ class Server(object):
         """
         Grants a bonus to a worker for an assignment.
         """
-        return self.client.reject_assignment(
-            WorkerId=workerid,
-            AssignmentId=assignmentid,
-            BonusAmount='%0.2f' % amount,
-            Reason=feedback
-        )
+        try:
+            return self.client.send_bonus(
+                WorkerId=workerid,
+                AssignmentId=assignmentid,
+                BonusAmount=format(amount, ".2f"),
+                Reason=feedback,
+                UniqueRequestToken=uuid.uuid4().hex
+            )
+        except ClientError as e:
+            if not duplicaterequest(e):
+                raise
+            # an attempt that timed out already paid it
+            logger.warning("Bonus for {0} was paid by an earlier attempt"
+                           .format(assignmentid))
+            return {"ResponseMetadata": e.response["ResponseMetadata"]}
 
     def block(self, workerid, reason=""):
         """
@@ -158,7 +231,12 @@ class Server(object):
         Returns a response object with the available balance in the amount
         attribute.
         """
-        return float(self.client.get_account_balance()["AvailableBalance"])
+        now = time.monotonic()
+        if self.balancecache and now - self.balancecache[0] < self.balancettl:
+            return self.balancecache[1]
+        balance = float(self.client.get_account_balance()["AvailableBalance"])
+        self.balancecache = now, balance
+        return balance
 
     @property
     def rewardpayout(self):
@@ -193,12 +271,25 @@ class Server(object):
         return self.getstatistic("NumberHITsCreated", int)
 
 
+serverlock = threading.Lock()
+
 try:
     import config
 except ImportError:
     pass
 else:
-    server = Server(config.signature,
-                    config.accesskey,
-                    config.localhost,
-                    config.sandbox)
+    def __getattr__(name):
+        """
+        Builds api.server on first use so commands that never talk to MTurk
+        do not pay for constructing the boto3 client.
+        """
+        if name != "server":
+            raise AttributeError("module {0!r} has no attribute {1!r}"
+                                 .format(__name__, name))
+        with serverlock:
+            if "server" not in globals():
+                globals()["server"] = Server(config.signature,
+                                             config.accesskey,
+                                             config.localhost,
+                                             config.sandbox)
+        return globals()["server"]
@@ -1,5 +1,5 @@
 from xml.etree import ElementTree
-import urllib2
+from urllib.request import urlopen
 import logging
 
 logger = logging.getLogger("turkic.geolocation")
@@ -33,7 +33,7 @@ cache = {}
 def lookup(ip):
     if ip not in cache:
         logger.info("Query for {0}".format(ip))
-        response = urllib2.urlopen("http://api.ipinfodb.com/v3/ip-city?"
+        response = urlopen("http://api.ipinfodb.com/v3/ip-city?"
             "key={0}&ip={1}&format=xml".format(apikey, ip))
         xml = ElementTree.parse(response)
 
@@ -1,8 +1,8 @@
-import api
+from turkic import api
 from sqlalchemy import Column, Integer, String, Text, Float, Boolean
 from sqlalchemy import ForeignKey, Index, DateTime, Numeric
 from sqlalchemy.orm import relationship, backref
-import database
+from turkic import database
 import random
 import logging
 import math
@@ -114,10 +114,17 @@ class HIT(database.Base):
                        "with_polymorphic": "*"}
 
     def publish(self):
+        self.markpublished(api.server.createhit(**self.hitparameters()))
+
+    def hitparameters(self):
+        """
+        Returns the keyword arguments for api.server.createhit(). Split from
+        publish() so the network call can be made away from the session.
+        """
         if self.published:
             raise RuntimeError("HIT cannot be published because it has already"
                 " been published.")
-        resp = api.server.createhit(
+        return dict(
             title = self.group.title,
             description = self.group.description,
             amount = self.group.cost,
@@ -129,6 +136,8 @@ class HIT(database.Base):
             minapprovedpercent = self.group.minapprovedpercent,
             countrycode = self.group.countrycode,
             page = self.getpage())
+
+    def markpublished(self, resp):
         self.hitid = resp['HIT']['HITId']
         self.published = True
         logger.debug("Published HIT {0}".format(self.hitid))
@@ -203,7 +212,7 @@ class HIT(database.Base):
         try:
           api.server.reject(self.assignmentid, reason)
         except:
-          print "Failed to reject {0}".format(self.assignmentid)
+          print("Failed to reject {0}".format(self.assignmentid))
         self.accepted = False
         self.compensated = True
         self.worker.numrejections += 1
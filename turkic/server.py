@@ -100,7 +100,7 @@ class Error404(Exception):
 
 
 
-import models
+from turkic import models
 from datetime import datetime
 
 def getjobstats(hitid, workerid):